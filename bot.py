@@ -1,19 +1,26 @@
 import os
-import json
 import logging
+import random
 import time
 import asyncio
-import traceback  # Added for traceback handling
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import orjson
 from mattermostdriver import Driver
 from requests.exceptions import RequestException
 from websocket import WebSocketConnectionClosedException
 from message_handler import handle_message  # Import the handle_message function
 from channel_notification import send_initial_channel_notification  # Import the notification function
 
+try:
+    import uvloop  # Faster drop-in event loop, optional since it is not available everywhere (e.g. Windows)
+except ImportError:
+    uvloop = None
+
 # Set up application-level logging
 app_debug_mode = os.getenv("APP_DEBUG", "false").lower() == "true"
 app_log_level = logging.DEBUG if app_debug_mode else logging.INFO
-logging.basicConfig(level=app_log_level)
 
 # Configure dedicated loggers for message_handler and channel_notification
 logging.getLogger('message_handler').setLevel(logging.DEBUG)
@@ -25,6 +32,10 @@ network_log_level = logging.DEBUG if network_debug_mode else logging.INFO
 
 logging.getLogger('mattermostdriver.websocket').setLevel(network_log_level)
 
+# How the bot receives messages: "websocket" only, "polling" only,
+# or "hybrid" (WebSocket first, falling back to polling when it fails)
+BOT_MODES = ("websocket", "polling", "hybrid")
+
 class MattermostBot:
     def __init__(self):
         self.host = os.getenv("MATTERMOST_HOST")
@@ -32,10 +43,29 @@ class MattermostBot:
         self.token = os.getenv("MATTERMOST_TOKEN")
         self.team_name = os.getenv("MATTERMOST_TEAM")
         self.port = int(os.getenv("MATTERMOST_PORT", 443))  # Default to 443, but allow override
+        self.mode = os.getenv("BOT_MODE", "hybrid").lower()
+        if self.mode not in BOT_MODES:
+            raise ValueError(f"Unknown BOT_MODE '{self.mode}', expected one of: {', '.join(BOT_MODES)}")
         self.poll_interval = 10  # Time to wait between polling for new messages (in seconds)
         self.reconnect_delay = 15 * 60  # Time to wait (15 minutes) before retrying WebSocket after polling
-
-        # Initialize the Mattermost driver with network debugging based on the NETWORK_DEBUG flag
+        self.poll_semaphore = asyncio.Semaphore(16)  # Upper bound on concurrent requests while polling
+        self.reconnect_backoff = 1.0  # Last WebSocket reconnect delay (in seconds), grows while retries keep failing
+        self.max_reconnect_backoff = 300  # Upper bound on the WebSocket reconnect delay (in seconds)
+        self.bot_user_id = None  # Cached at login, the bot's own user ID never changes
+        self.receiving = False  # Whether the current run() got as far as receiving messages, decides how it is restarted
+        self.post_queue = asyncio.Queue(maxsize=1024)  # Received posts waiting for a dispatch worker
+        self.dispatch_workers = 8  # Number of posts handled concurrently, one per thread of the executor below
+        self.structured_posts_seen = False  # Whether the server sent data.post as an object instead of a JSON string
+
+        # Base URLs for the non-blocking REST and WebSocket clients
+        self.api_url = f"{self.scheme}://{self.host}:{self.port}/api/v4"
+        websocket_scheme = "wss" if self.scheme == "https" else "ws"
+        self.websocket_url = f"{websocket_scheme}://{self.host}:{self.port}/api/v4/websocket"
+        self.session = None  # aiohttp.ClientSession, opened in run() once the event loop is running
+
+        # Initialize the Mattermost driver with network debugging based on the NETWORK_DEBUG flag.
+        # The driver is synchronous (requests-based); it is only used for posting: the start-up
+        # announcement, and the replies posted by message_handler's post queue threads.
         self.driver = Driver({
             'url': self.host,
             'token': self.token,
@@ -45,167 +75,335 @@ class MattermostBot:
             'debug': network_debug_mode  # Enable or disable network debug mode based on the NETWORK_DEBUG flag
         })
 
+        # Dedicated threads for the synchronous message handlers and the start-up announcement, so
+        # they neither stall the event loop nor compete with asyncio's default executor. The handlers
+        # only queue their replies, the hop keeps their CPU work (keyword scan, logging) off the loop.
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mmdriver")
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Run a blocking call on the bot's thread pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def open_session(self):
+        """Open the shared HTTP session, registering the bearer token once for all requests."""
+        if self.session is None or self.session.closed:
+            # One connection pool for all REST calls: connections (and their TLS handshakes) are
+            # reused across polling ticks, and a full fan-out fits into the per-host limit
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'Authorization': f"Bearer {self.token}"},
+                json_serialize=lambda payload: orjson.dumps(payload).decode(),
+                raise_for_status=True
+            )
+
+    async def api_get(self, endpoint, params=None):
+        """Issue a GET against the Mattermost REST API without blocking the event loop."""
+        async with self.session.get(f"{self.api_url}{endpoint}", params=params) as response:
+            return await response.json(loads=orjson.loads)
+
+    async def api_post(self, endpoint, payload):
+        """Issue a POST against the Mattermost REST API without blocking the event loop."""
+        async with self.session.post(f"{self.api_url}{endpoint}", json=payload) as response:
+            return await response.json(loads=orjson.loads)
+
     async def run(self):
+        workers = []
+        self.receiving = False
         try:
+            await self.open_session()
+
             logging.info("Logging in to Mattermost...")
-            self.driver.login()
+            # Get current user information (for the bot user), this also validates the token
+            bot_user = await self.api_get("/users/me")
+            bot_user_id = bot_user['id']
+            self.bot_user_id = bot_user_id
+
+            # Hand the token to the synchronous driver the same way Driver.login() does,
+            # without paying for a second /users/me round-trip
+            self.driver.client.token = self.token
+            self.driver.client.userid = bot_user_id
             logging.info("Login successful!")
+            logging.info("Bot user ID: %s", bot_user_id)
+
+            # Handle received posts in the background, so receiving never waits on a reply
+            workers = [asyncio.create_task(self.dispatch_posts()) for _ in range(self.dispatch_workers)]
 
             # Get team info
-            team = self.driver.teams.get_team_by_name(self.team_name)
-            if not team:
-                logging.error(f"Team '{self.team_name}' not found.")
+            try:
+                team = await self.api_get(f"/teams/name/{self.team_name}")
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise
+                logging.error("Team '%s' not found.", self.team_name)
                 return
             team_id = team['id']
 
-            # Get current user information (for the bot user)
-            bot_user = self.driver.users.get_user('me')
-            bot_user_id = bot_user['id']
-            logging.info(f"Bot user ID: {bot_user_id}")
-
             # Find or create a direct message (DM) channel with the bot user
-            private_channel_id = self.get_private_channel(bot_user_id)
+            private_channel_id = await self.get_private_channel(bot_user_id)
             if private_channel_id:
                 # Get all channel names and send the notification using the external function
-                channel_names = self.get_channel_names(bot_user_id, team_id)
-                send_initial_channel_notification(self.driver, private_channel_id, channel_names)
+                channel_names = await self.get_channel_names(bot_user_id, team_id)
+                await self.run_blocking(send_initial_channel_notification, self.driver, private_channel_id, channel_names)
             else:
                 logging.error("Failed to find or create a private channel for the bot.")
 
-            # Attempt WebSocket connection first, with a fallback to polling
-            await self.connect_websocket_or_fallback(bot_user_id, team_id)
+            self.receiving = True
+            if self.mode == "polling":
+                await self.poll_messages(bot_user_id, team_id)
+            else:
+                # Attempt WebSocket connection first, with a fallback to polling in hybrid mode
+                await self.connect_websocket_or_fallback(bot_user_id, team_id)
+
+        finally:
+            # Errors are left to the caller, which decides whether and when to restart
+            for worker in workers:
+                worker.cancel()
+            await self.session.close()
 
-        except RequestException as e:
-            logging.error(f"RequestException during login or API call: {e}")
-        except Exception as e:
-            logging.error(f"Unexpected error occurred: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+    async def dispatch_posts(self):
+        """Worker: take received posts off the queue and hand them to the message handler."""
+        while True:
+            post_data = await self.post_queue.get()
+            try:
+                # The handler is synchronous, keep it off the event loop; its replies are posted
+                # by message_handler's post queue
+                await self.run_blocking(handle_message, self.driver, post_data, self.bot_user_id)
+            except Exception as e:
+                logging.exception("Unexpected error dispatching message: %s", e)
+            finally:
+                self.post_queue.task_done()
+
+    async def get_channels(self, bot_user_id, team_id):
+        """Get the channels the bot is a member of."""
+        return await self.api_get(f"/users/{bot_user_id}/teams/{team_id}/channels")
 
-    def get_private_channel(self, bot_user_id):
+    async def get_private_channel(self, bot_user_id):
         """Find or create a private DM channel for the bot."""
         try:
             logging.info("Retrieving bot's private channel...")
 
             # Find or create the direct message channel with the bot user
-            direct_channel = self.driver.channels.create_direct_message_channel([bot_user_id, bot_user_id])
+            direct_channel = await self.api_post("/channels/direct", [bot_user_id, bot_user_id])
 
             if direct_channel and 'id' in direct_channel:
-                logging.info(f"Private DM channel created/found with ID: {direct_channel['id']}")
+                logging.info("Private DM channel created/found with ID: %s", direct_channel['id'])
                 return direct_channel['id']
             else:
                 logging.error("Failed to create/find a direct message channel.")
                 return None
         except Exception as e:
-            logging.error(f"Error getting private channel: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+            logging.exception("Error getting private channel: %s", e)
             return None
 
-    def get_channel_names(self, bot_user_id, team_id):
+    async def get_channel_names(self, bot_user_id, team_id):
         """Get a list of channel names the bot has access to in the team."""
         try:
             logging.info("Retrieving channel names...")
-            channels = self.driver.channels.get_channels_for_user(bot_user_id, team_id)
-            channel_names = [channel['display_name'] for channel in channels if 'display_name' in channel]
-            logging.debug(f"Channel names: {channel_names}")
-            return '\n'.join(channel_names)  # Return channel names as a newline-separated string
+            channels = await self.get_channels(bot_user_id, team_id)
+            # Single pass over the channels, without an intermediate list
+            channel_names = '\n'.join(channel['display_name'] for channel in channels if 'display_name' in channel)
+            logging.debug("Channel names: %s", channel_names)
+            return channel_names  # Return channel names as a newline-separated string
         except Exception as e:
-            logging.error(f"Error retrieving channel names: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+            logging.exception("Error retrieving channel names: %s", e)
             return "No channels found."
 
     async def connect_websocket_or_fallback(self, bot_user_id, team_id):
-        """Attempt to connect to WebSocket, and fall back to polling if it fails."""
-        try:
-            logging.info("Attempting WebSocket connection...")
+        """Attempt to connect to WebSocket, and fall back to polling if it fails.
+
+        In websocket mode there is no fallback, the connection is retried instead.
+        """
+        while True:
+            try:
+                logging.info("Attempting WebSocket connection...")
+
+                await self.listen_websocket()
+
+            except WebSocketConnectionClosedException as e:
+                logging.error("WebSocket connection failed: %s.", e)
+            except aiohttp.ClientResponseError as e:
+                if e.status in (401, 403):
+                    # Retrying will not fix a rejected token
+                    logging.error("WebSocket authentication failed: %s. Not retrying.", e)
+                    raise
+                logging.error("Error establishing WebSocket connection: %s", e)
+            except Exception as e:
+                logging.exception("Error establishing WebSocket connection: %s", e)
 
-            # Await WebSocket connection if it's async
-            await self.driver.init_websocket(self.on_message)  # WebSocket message handler
+            if self.mode == "hybrid":
+                logging.info("Switching to polling mode.")
+                await self.poll_messages(bot_user_id, team_id)
+                return
 
-        except WebSocketConnectionClosedException as e:
-            logging.error(f"WebSocket connection failed: {e}. Switching to polling mode.")
-            await self.poll_messages(bot_user_id, team_id)
-        except Exception as e:
-            logging.error(f"Error establishing WebSocket connection: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
-            await self.poll_messages(bot_user_id, team_id)
+            delay = self.next_reconnect_delay()
+            logging.info("Retrying WebSocket connection in %.1f seconds...", delay)
+            await asyncio.sleep(delay)
+
+    def next_reconnect_delay(self):
+        """Capped exponential backoff with decorrelated jitter for WebSocket reconnects.
+
+        The random spread keeps several bot instances from retrying in lockstep
+        against a Mattermost server that is just coming back.
+        """
+        delay = min(self.max_reconnect_backoff, random.uniform(1, self.reconnect_backoff * 3))
+        self.reconnect_backoff = delay
+        return delay
+
+    async def listen_websocket(self):
+        """Receive events from the Mattermost WebSocket until the connection closes."""
+        # The bearer token registered on the session authenticates the upgrade request
+        async with self.session.ws_connect(self.websocket_url, heartbeat=30) as websocket:
+            logging.info("WebSocket connection established.")
+            self.reconnect_backoff = 1.0
+            async for frame in websocket:
+                if frame.type == aiohttp.WSMsgType.TEXT:
+                    await self.on_message(frame.data)  # WebSocket message handler
+                elif frame.type == aiohttp.WSMsgType.ERROR:
+                    break
+
+        raise WebSocketConnectionClosedException("WebSocket connection closed by the server")
 
     async def on_message(self, message):
         """Handle incoming messages from WebSocket."""
         try:
-            logging.info(f"New message received: {message}")
+            # Every WebSocket event (typing, status, ...) passes through here, keep it at debug level
+            logging.debug("New message received: %s", message)
 
             # Ensure the message is parsed as JSON
-            if isinstance(message, str):
-                message = json.loads(message)
+            if isinstance(message, (str, bytes)):
+                message = orjson.loads(message)
 
             # Extract the post data from the message
             if 'event' in message and message['event'] == 'posted':
-                post_data = json.loads(message['data']['post'])
-                handle_message(self.driver, post_data)  # Use the imported handle_message
-
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decoding JSON message: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+                # Mattermost sends the post as a JSON string nested in the event, only decode it
+                # when the server has not already sent it as an object
+                post = message['data']['post']
+                if isinstance(post, dict):
+                    post_data = post
+                    if not self.structured_posts_seen:
+                        self.structured_posts_seen = True
+                        logging.info("WebSocket delivers posts as objects, skipping the nested JSON decode.")
+                else:
+                    post_data = orjson.loads(post)
+                # The bot's own replies come back as events too, drop them before dispatching
+                if post_data.get('user_id') == self.bot_user_id:
+                    return
+                await self.post_queue.put(post_data)
+
+        except orjson.JSONDecodeError as e:
+            logging.exception("Error decoding JSON message: %s", e)
         except KeyError as e:
-            logging.error(f"KeyError: Missing key {e} in message: {message}")
-            logging.error(traceback.format_exc())  # Print full traceback
-        except RequestException as e:
-            logging.error(f"RequestException handling WebSocket message: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+            logging.exception("KeyError: Missing key %s in message: %s", e, message)
+        except (RequestException, aiohttp.ClientError) as e:
+            logging.exception("RequestException handling WebSocket message: %s", e)
         except Exception as e:
-            logging.error(f"Unexpected error handling WebSocket message: {e}")
-            logging.error(traceback.format_exc())  # Print full traceback
+            logging.exception("Unexpected error handling WebSocket message: %s", e)
+
+    async def fetch_posts(self, channel_id, since):
+        """Fetch the posts of a channel created or changed since the given timestamp (in milliseconds)."""
+        async with self.poll_semaphore:
+            return await self.api_get(f"/channels/{channel_id}/posts", params={'since': since})
 
     async def poll_messages(self, bot_user_id, team_id):
         """Poll the channels for new messages and handle them."""
         last_checked = int(time.time())  # Start polling from the current time
+        previous_post_ids = set()  # Posts returned by the last tick, the overlapping window returns them again
         polling_start_time = time.time()  # Track the time when polling starts
 
         while True:
             try:
                 logging.debug("Polling for new messages...")
-                channels = self.driver.channels.get_channels_for_user(bot_user_id, team_id)
-
-                for channel in channels:
-                    posts = self.driver.posts.get_posts_for_channel(channel['id'], params={'since': last_checked * 1000})
+                # Taken before the listing, so a post arriving while this tick runs is
+                # still newer than the next tick's cutoff
+                tick_start = int(time.time())
+                # Fetched every tick: the listing's last_post_at is what tells us which channels
+                # have new posts, a stale listing would skip them for good
+                channels = await self.get_channels(bot_user_id, team_id)
+                since = last_checked * 1000
+
+                # The channel listing already carries each channel's last activity,
+                # so channels without new posts do not need a request of their own
+                active_channels = [channel for channel in channels if channel.get('last_post_at', since) >= since]
+
+                # Fetch the active channels concurrently rather than one round-trip after another
+                results = await asyncio.gather(
+                    *(self.fetch_posts(channel['id'], since) for channel in active_channels),
+                    return_exceptions=True
+                )
+
+                post_ids = set()
+                for channel, posts in zip(active_channels, results):
+                    if isinstance(posts, Exception):
+                        logging.error("Error fetching posts for channel %s: %s", channel['id'], posts)
+                        continue
                     if 'posts' in posts:
                         for post_id, post_data in posts['posts'].items():
-                            handle_message(self.driver, post_data)  # Use the imported handle_message
+                            post_ids.add(post_id)
+                            if post_id in previous_post_ids or post_data.get('user_id') == self.bot_user_id:
+                                continue
+                            await self.post_queue.put(post_data)
 
-                last_checked = int(time.time())
+                last_checked = tick_start
+                previous_post_ids = post_ids
 
                 # Check if 15 minutes have passed to retry WebSocket
-                if time.time() - polling_start_time >= self.reconnect_delay:
+                if self.mode == "hybrid" and time.time() - polling_start_time >= self.reconnect_delay:
                     logging.info("15 minutes of polling passed. Retrying WebSocket connection.")
-                    try:
-                        await self.connect_websocket_or_fallback(bot_user_id, team_id)
-                        break  # Exit polling loop if WebSocket succeeds
-                    except WebSocketConnectionClosedException as e:
-                        logging.error(f"WebSocket reconnection failed: {e}. Continuing polling.")
-                        polling_start_time = time.time()  # Reset polling start time after WebSocket failure
-
-            except RequestException as e:
-                logging.error(f"RequestException while polling for messages: {e}")
-                logging.error(traceback.format_exc())  # Print full traceback
+                    # A failed attempt goes back to polling by itself, only a rejected token
+                    # (401/403) gets out of it, and that ends polling too (see below)
+                    await self.connect_websocket_or_fallback(bot_user_id, team_id)
+                    break  # Exit polling loop if WebSocket succeeds
+
+            except aiohttp.ClientResponseError as e:
+                if e.status in (401, 403):
+                    # Retrying will not fix a rejected token, leave that to the caller
+                    raise
+                logging.exception("RequestException while polling for messages: %s", e)
+            except (RequestException, aiohttp.ClientError) as e:
+                logging.exception("RequestException while polling for messages: %s", e)
             except Exception as e:
-                logging.error(f"Unexpected error while polling for messages: {e}")
-                logging.error(traceback.format_exc())  # Print full traceback
+                logging.exception("Unexpected error while polling for messages: %s", e)
 
-            logging.debug(f"Sleeping for {self.poll_interval} seconds before next poll...")
+            logging.debug("Sleeping for %s seconds before next poll...", self.poll_interval)
             await asyncio.sleep(self.poll_interval)
 
 if __name__ == "__main__":
+    # Configure the root handler once, at process start rather than on import
+    logging.basicConfig(level=app_log_level)
+
     bot = MattermostBot()
 
     async def run_bot():
         while True:
+            delay = 0
             try:
                 await bot.run()  # Run the bot asynchronously
+            except aiohttp.ClientResponseError as e:
+                if e.status in (401, 403):
+                    logging.error("Mattermost rejected the bot's credentials: %s. Giving up.", e)
+                    break
+                logging.error("RequestException during login or API call: %s", e)
+                delay = bot.next_reconnect_delay()
+            except (RequestException, aiohttp.ClientError, WebSocketConnectionClosedException) as e:
+                logging.error("Connection to Mattermost lost: %s", e)
+                if bot.receiving:
+                    # A connection that dropped while the bot was receiving is re-established
+                    # right away, and its failures start over with short delays
+                    bot.reconnect_backoff = 1.0
+                else:
+                    delay = bot.next_reconnect_delay()
             except Exception as e:
-                logging.error(f"Bot crashed with error: {e}")
-                logging.error(traceback.format_exc())  # Print full traceback
-                logging.info(f"Restarting bot in {bot.poll_interval} seconds...")
-                await asyncio.sleep(bot.poll_interval)  # Use asyncio.sleep in async code
+                logging.exception("Bot crashed with error: %s", e)
+                delay = bot.next_reconnect_delay()
+            else:
+                # run() only returns when there is nothing to serve (e.g. the team is missing),
+                # check again later rather than in a tight loop
+                delay = bot.next_reconnect_delay()
+            if delay:
+                logging.info("Restarting bot in %.1f seconds...", delay)
+                await asyncio.sleep(delay)  # Use asyncio.sleep in async code
 
     # Check if the event loop is already running
     try:
@@ -214,4 +412,8 @@ if __name__ == "__main__":
         loop.create_task(run_bot())
     except RuntimeError:  # No loop is running
         logging.info("No event loop running. Starting new event loop.")
-        asyncio.run(run_bot())
+        if uvloop is not None:
+            logging.info("Using uvloop event loop.")
+            uvloop.run(run_bot())
+        else:
+            asyncio.run(run_bot())
@@ -1,79 +1,163 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from requests.exceptions import RequestException
 import os
-import sys
+from pathlib import Path
+import queue
+import re
+import threading
 import time
 
 # Define the log directory and file
 log_directory = 'logs'
 log_file = os.path.join(log_directory, 'message_handler.log')
 
-# Create the log directory if it doesn't exist
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory, exist_ok=True)
+def setup_logger(logger):
+    """Attach the file and console handlers to the logger, returning the started queue listener."""
+    # Create the log directory if it doesn't exist
+    Path(log_directory).mkdir(parents=True, exist_ok=True)
+
+    # Set logging level (this can be customized)
+    logger.setLevel(logging.DEBUG)
+
+    # Create handlers for both file and console
+    file_handler = TimedRotatingFileHandler(log_file, when="midnight", interval=1, backupCount=30)
+    file_handler.suffix = "%Y-%m-%d"  # Log files will be named with a date suffix
+
+    console_handler = logging.StreamHandler()
+
+    # Set log level for each handler (optional)
+    file_handler.setLevel(logging.DEBUG)
+    console_handler.setLevel(logging.DEBUG)
+
+    # Create a logging format
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    # The logger only enqueues records, so handling a message never waits on a disk write. The
+    # message text (%-arguments, tracebacks) is still formatted by the logging thread when the
+    # record is queued; the listener thread applies the layout and does the file and console I/O.
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    # The listener has its own console handler: passing records on to the root logger's handlers
+    # would print them twice, and write them synchronously on the handling thread
+    logger.propagate = False
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on shutdown
+    return listener
 
 # Create a dedicated logger for message_handler
 logger = logging.getLogger('message_handler')
 
-# Set logging level (this can be customized)
-logger.setLevel(logging.DEBUG)
+# Set up the handlers only once, even if the module is imported again (e.g. reloaded).
+# The listener kept on the logger is the marker: hasHandlers() would also look at parent loggers.
+if getattr(logger, 'queue_listener', None) is None:
+    logger.queue_listener = setup_logger(logger)
+queue_listener = logger.queue_listener
+
+def log_exceptions(fn):
+    """Decorator for the message handling functions: log their errors instead of raising them."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except RequestException as e:
+            logger.error("RequestException in %s: %s", fn.__name__, e)
+        except Exception:
+            logger.exception("Unexpected error in %s", fn.__name__)
+    return wrapper
+
+# Keyword flags, combined into a bitmask by scan_keywords()
+HELLO = 1
+HELP = 2
+RESTART = 4
+DIRECT = 8  # Not a keyword: the message starts with a mention of the bot
 
-# Create handlers for both file and console
-file_handler = TimedRotatingFileHandler(log_file, when="midnight", interval=1, backupCount=30)
-file_handler.suffix = "%Y-%m-%d"  # Log files will be named with a date suffix
+# The command vocabulary, each keyword mapped to its flag
+COMMANDS = {"hello": HELLO, "help": HELP, "restart": RESTART}
 
-console_handler = logging.StreamHandler()
+# Ways a message can start to address the bot directly
+BOT_MENTION = frozenset({"@avarc-chatops-bot", "avarc-chatops-bot"})
+BOT_MENTION_PREFIXES = tuple(BOT_MENTION)
+BOT_MENTION_LENGTH = max(map(len, BOT_MENTION))
 
-# Set log level for each handler (optional)
-file_handler.setLevel(logging.DEBUG)
-console_handler.setLevel(logging.DEBUG)
+# The keywords as words of their own, found in one pass over the raw message (the same
+# matches as comparing the words of a lowercased, split() message). Compiled once, so
+# messages without a keyword are rejected without lowercasing and splitting them.
+COMMAND_PATTERN = re.compile(
+    r"(?<!\S)(?P<keyword>" + "|".join(map(re.escape, COMMANDS)) + r")(?!\S)",
+    re.IGNORECASE
+)
 
-# Create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+def is_direct_message(message_text):
+    """Whether the message starts with a mention of the bot."""
+    # Only the start of the message is lowercased, however long the message is.
+    # lstrip() returns the very same string when there is no leading whitespace.
+    return message_text.lstrip()[:BOT_MENTION_LENGTH].lower().startswith(BOT_MENTION_PREFIXES)
 
-# Add handlers to the logger
-if not logger.hasHandlers():  # To prevent adding multiple handlers if reloaded
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+def scan_keywords(message_text):
+    """Return the bitmask of all keywords in the message, found in a single pass."""
+    flags = 0
+    for match in COMMAND_PATTERN.finditer(message_text):
+        # Case-insensitive matching accepts a few non-ASCII look-alikes that lower() does not
+        # map to a keyword, get() leaves those out just like the word comparison did
+        flags |= COMMANDS.get(match.group('keyword').lower(), 0)
+    return flags
 
-def is_direct_message(words=None):
-    logging.info(f"is_direct_message: list of words: {words}")
-    return words[0].lower().startswith("@avarc-chatops-bot")
+# Static reply texts
+DIRECT_TEXT = "Are you talking to me :thinking_face: :question:"
+HELLO_TEXT = "... again, General Kenobi :crossed_swords:"
+HELP_TEXT = (
+    "Here are the commands I respond to: ...\n"
+    "  hello - Try it :wink:\n"
+    "  help - This message :nerd_face:\n"
+    "  restart - Restart something on the server"
+)
+RESTART_OPTIONS_TEXT = (
+    "Restart? I know how to restart:\n"
+    "... myself\n"
+    "... backend\n"
+    "Maybe tell me explicitly what you want me to do :sweat_smile:"
+)
 
-def contains_hello_keyword(words=None):
-    # logging.info(f"contains_hello_keyword: list of words: {words}")
-    return any(word == "hello" for word in words)
+# The bot's own user ID, looked up on first use for callers that do not pass it in
+_bot_user_id = None
 
-def contains_help_keyword(words=None):
-    # logging.info(f"contains_help_keyword: list of words: {words}")
-    return any(word == "help" for word in words)
+def get_bot_user_id(driver):
+    """Return the bot's user ID, fetching it from Mattermost only the first time."""
+    global _bot_user_id
+    if _bot_user_id is None:
+        _bot_user_id = driver.users.get_user('me')['id']
+    return _bot_user_id
 
-def contains_restart_keyword(words=None):
-    # logging.info(f"contains_restart_keyword: list of words: {words}")
-    return any(word == "restart" for word in words)
+def find_restart_index(words):
+    """Return the position of the "restart" keyword in the words, or -1 if it is not there."""
+    for index, word in enumerate(words):
+        if word == "restart":
+            return index
+    return -1
 
-def handle_restart_message(driver, channel_id, words:None):
-    if "restart" in words:
-        restart_index = words.index("restart")
+@log_exceptions
+def handle_restart_message(driver, channel_id, words, restart_index):
+    if restart_index >= 0:
+        word_count = len(words)
 
-        logger.info(f"Checking what to restart: '{words}', restart: {restart_index}, length: {len(words)}")
+        logger.info("Checking what to restart: '%s', restart: %s, length: %s", words, restart_index, word_count)
 
-        if restart_index + 1 == len(words):
-            what_to_restart_message = "Restart? I know how to restart:\n"
-            what_to_restart_message += "... myself\n"
-            what_to_restart_message += "... backend\n"
-            what_to_restart_message += "Maybe tell me explicitly what you want me to do :sweat_smile:"
-            send_mattermost_message(driver, channel_id, what_to_restart_message)
-        elif restart_index + 1 < len(words):
+        if restart_index + 1 == word_count:
+            send_mattermost_message(driver, channel_id, RESTART_OPTIONS_TEXT)
+        elif restart_index + 1 < word_count:
             if words[restart_index + 1] == "yourself":
                 # If "yourself" is detected after "restart", send the seppuku message and exit
                 restart_myself_message = "I shall restart myself? Hopefully my scion will be an improved version... :innocent:"
                 send_mattermost_message(driver, channel_id, restart_myself_message)
-                time.sleep(5)
-                sys.exit(0)  # Exit with success code 0
+                # Exit in 5 seconds, without holding up this handler thread in the meantime
+                threading.Timer(5.0, exit_process).start()
             else:
                 unknown_service_message = "I don't know what this is, staying my hand..."
                 send_mattermost_message(driver, channel_id, unknown_service_message)
@@ -83,64 +167,162 @@ def handle_restart_message(driver, channel_id, words:None):
             send_mattermost_message(driver, channel_id, "WUD ???")
 
 
-def handle_message(driver, post_data):
-    """Process a new message."""
-    try:
-        logger.info("")
-        logger.info(f"New message received: {post_data}")
-        logger.info("")
+# Reply functions for the command table below. Each returns the text to add to the reply,
+# or None when it has nothing to add (the restart command posts its replies itself).
+def reply_direct(driver, channel_id, message_text):
+    return DIRECT_TEXT
 
-        channel_id = post_data['channel_id']
-        message_text = post_data['message']
-        user_id = post_data['user_id']
+def reply_help(driver, channel_id, message_text):
+    return HELP_TEXT
 
-        # Check if the message was sent by the bot itself to avoid an infinite loop
-        bot_user = driver.users.get_user('me')
-        if user_id == bot_user['id']:
-            return
+def reply_hello(driver, channel_id, message_text):
+    return HELLO_TEXT
 
-        # Split the message into parts (by whitespace) and store in the "words" array
-        words = message_text.lower().split()
-        if words is None:
-            words = []
+def reply_restart(driver, channel_id, message_text):
+    # Only the restart command needs the message split into parts (by whitespace)
+    words = message_text.lower().split()
+    logger.info("incoming message: list of words: %s", words)
+    handle_restart_message(driver, channel_id, words, find_restart_index(words))
 
-        logging.info(f"incoming message: list of words: {words}")
+def command_handlers(flags):
+    """The reply functions for a combination of flags, in the order their replies are sent."""
+    handlers = []
+    if flags & DIRECT:
+        # "restart" is only acted upon when the bot is addressed directly
+        handlers.append(reply_restart if flags & RESTART else reply_direct)
+    if flags & HELP:
+        handlers.append(reply_help)
+    elif flags & HELLO:
+        handlers.append(reply_hello)
+    return tuple(handlers)
 
-        if is_direct_message(words):
-            if contains_restart_keyword(words):
-                handle_restart_message(driver, channel_id, words)
-            else:
-                send_mattermost_message(driver,
-                                        channel_id,
-                                        "Are you talking to me :thinking_face: :question:")
-
-        if contains_help_keyword(words):
-            response = "Here are the commands I respond to: ..."
-            response += "\n"
-            response += "  hello - Try it :wink:"
-            response += "\n"
-            response += "  help - This message :nerd_face:"
-            response += "\n"
-            response += "  restart - Restart something on the server"
-            send_mattermost_message(driver, channel_id, response)
-        elif contains_hello_keyword(words):
-            response = "... again, General Kenobi :crossed_swords:"
-            send_mattermost_message(driver, channel_id, response)
-
-    except RequestException as e:
-        logger.error(f"RequestException handling message: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error handling message: {e}")
+# Every combination of flags mapped to its reply functions, computed once,
+# so dispatching a message is a single lookup
+COMMAND_TABLE = tuple(command_handlers(flags) for flags in range((HELLO | HELP | RESTART | DIRECT) + 1))
+
+@log_exceptions
+def handle_message(driver, post_data, bot_user_id=None):
+    """Process a new message.
+
+    Callers that already know the bot's user ID can pass it in, otherwise it
+    is looked up once and cached for all later messages.
+    """
+    # Check if the message was sent by the bot itself to avoid an infinite loop,
+    # before doing any other work on it
+    if bot_user_id is None:
+        bot_user_id = get_bot_user_id(driver)
+    if post_data['user_id'] == bot_user_id:
+        return
+
+    message_text = post_data['message']
+    flags = scan_keywords(message_text)
+    if is_direct_message(message_text):
+        flags |= DIRECT
+
+    # Most channel traffic is not for the bot, reject it before logging or splitting it
+    handlers = COMMAND_TABLE[flags]
+    if not handlers:
+        return
+
+    logger.info("New message received: %s", post_data)
+
+    channel_id = post_data['channel_id']
 
+    # Collect the replies and send them as one message
+    parts = []
+    for handler in handlers:
+        reply = handler(driver, channel_id, message_text)
+        if reply:
+            parts.append(reply)
+
+    if parts:
+        send_mattermost_message(driver, channel_id, "\n".join(parts))
+
+class PostQueue:
+    """Posts replies from a background thread, coalescing the replies queued for the same channel.
+
+    A batch is flushed once it holds max_batch replies, or max_wait seconds after its
+    first reply arrived. All replies of a batch that go to the same channel are joined
+    into a single post, so a handler sending several replies costs one round-trip.
+    The posts of a batch go to their channels concurrently, up to max_senders at a time.
+    """
+
+    def __init__(self, max_batch=10, max_wait=0.25, max_senders=8):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        # Threads are only started once there are posts to send
+        self.senders = ThreadPoolExecutor(max_workers=max_senders, thread_name_prefix="post-sender")
+        self.worker = None
+        self.worker_lock = threading.Lock()
+
+    def put(self, driver, channel_id, message):
+        """Queue a reply and return immediately."""
+        with self.worker_lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.process, name="post-queue", daemon=True)
+                self.worker.start()
+        self.pending.put((driver, channel_id, message))
+
+    def join(self, timeout=None):
+        """Block until every queued reply has been posted (or failed to post), or the timeout passed."""
+        with self.pending.all_tasks_done:
+            return self.pending.all_tasks_done.wait_for(lambda: not self.pending.unfinished_tasks, timeout)
+
+    def process(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.post_batch(batch)
+
+    def post_batch(self, batch):
+        # Group the replies per channel, keeping the order they were queued in
+        replies = {}
+        for driver, channel_id, message in batch:
+            replies.setdefault((driver, channel_id), []).append(message)
+
+        # Posts to different channels do not depend on each other, so none waits for another's round-trip
+        wait([
+            self.senders.submit(self.post_replies, driver, channel_id, messages)
+            for (driver, channel_id), messages in replies.items()
+        ])
+
+        for _ in batch:
+            self.pending.task_done()
+
+    def post_replies(self, driver, channel_id, messages):
+        try:
+            driver.posts.create_post({
+                'channel_id': channel_id,
+                'message': "\n".join(messages)
+            })
+        except RequestException as e:
+            logger.error("RequestException posting message: %s", e)
+        except Exception as e:
+            logger.exception("Unexpected error posting message: %s", e)
+
+# Shared by all handler threads, so replies to one channel are batched together
+post_queue = PostQueue()
+
+def exit_process():
+    """Terminate the bot once the queued replies are posted and the queued log records written."""
+    post_queue.join(timeout=10)
+    queue_listener.stop()
+    logging.shutdown()
+    # Handlers run in worker threads, where sys.exit() would only end the thread.
+    # Exit with success code 0, the service manager starts a fresh instance.
+    os._exit(0)
+
+@log_exceptions
 def send_mattermost_message(driver, channel_id, message: str):
-    try:
-        logger.info(f"send_mattermost_message: '{message}'")
-
-        driver.posts.create_post({
-            'channel_id': channel_id,
-            'message': message
-        })
-    except RequestException as e:
-        logger.error(f"RequestException handling message: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error handling message: {e}")
+    logger.info("send_mattermost_message: '%s'", message)
+
+    post_queue.put(driver, channel_id, message)